@@ -1,16 +1,29 @@
 import os
+import re
+import html
+import time
+import socket
 import asyncio
+import queue
+import atexit
 import logging
-from typing import Dict, Optional
-from contextlib import suppress
+import logging.handlers
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+from collections import deque
+from contextlib import suppress, asynccontextmanager
+from functools import lru_cache, partial
+from dataclasses import dataclass
+from datetime import timedelta
 
 import redis.asyncio as redis
+from redis.exceptions import ResponseError
+from redis.utils import HIREDIS_AVAILABLE
 import aiohttp
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 
 from aiogram import Bot, Dispatcher, Router, F, types
 from aiogram.enums import ParseMode
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import (
     Message,
     CallbackQuery,
@@ -22,8 +35,10 @@ from aiogram.types import (
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseEventIsolation, StorageKey
 from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
 
@@ -31,12 +46,32 @@ from aiogram.dispatcher.middlewares.base import BaseMiddleware
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 BANK_PASSWORD = os.getenv("BANK_PASSWORD", "bank123").strip()
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0").strip()
+REDIS_POOL = int(os.getenv("REDIS_POOL", "50"))  # макс. соединений в пуле
+# Сколько ждать свободное соединение, когда пул исчерпан (вместо мгновенной ошибки)
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "20"))
+# Таймаут чтения должен быть больше BLOCK у XREADGROUP в order_events_consumer (5 с)
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "10"))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "2"))
+# Брошенные FSM-сессии (state/data) Redis удалит сам по истечении TTL
+FSM_TTL = timedelta(hours=float(os.getenv("FSM_TTL_HOURS", "2")))
 
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "fxbank-secret").strip()
 WEBHOOK_PATH = f"/webhook/{WEBHOOK_SECRET}"
+# Сколько параллельных HTTPS-соединений Telegram откроет к вебхуку (1..100, по умолчанию у Telegram 40)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100"))
 
 HOST = "0.0.0.0"
 PORT = int(os.getenv("PORT", "10000"))
+# Процессы uvicorn (start.sh передаёт это же значение в --workers). При >1 воркере:
+#  - апдейты одного чата могут прийти в разные процессы, поэтому замок чата берётся
+#    в Redis (RedisEventIsolation), а не в памяти процесса — см. dp ниже;
+#  - token bucket'ы исходящей очереди живут в процессе — общий лимит отправки
+#    умножается на число воркеров;
+#  - set_webhook при старте и webhook_watchdog запускает каждый воркер (запросы
+#    идемпотентны, но getWebhookInfo уходит N раз за интервал);
+#  - кэш ролей и bank_ids — свои в каждом процессе (обновляются по TTL).
+# Рассылка заявок (consumer group) и антиспам (счётчик в Redis) общие.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
 
 # URL сервиса
 WEBHOOK_BASE = os.getenv("WEBHOOK_URL") or (
@@ -47,34 +82,141 @@ WEBHOOK_BASE = os.getenv("WEBHOOK_URL") or (
 
 # Watchdog и self-ping
 WATCHDOG_INTERVAL = int(os.getenv("WEBHOOK_WATCHDOG_INTERVAL", "60"))  # сек
+WATCHDOG_MAX_INTERVAL = int(os.getenv("WEBHOOK_WATCHDOG_MAX_INTERVAL", "900"))  # сек, потолок backoff
 SELF_PING_ENABLE = os.getenv("SELF_PING_ENABLE", "false").lower() == "true"
 SELF_PING_INTERVAL = int(os.getenv("SELF_PING_INTERVAL", "240"))  # сек
 
+# Роли общие для всех воркеров (Redis); локально кэшируем на столько секунд
+ROLE_CACHE_TTL = int(os.getenv("ROLE_CACHE_TTL", "30"))
+# Как часто перечитывать множество банков для рассылки (сек)
+BANK_IDS_REFRESH = int(os.getenv("BANK_IDS_REFRESH", "30"))
+
+# Повторные нажатия одной кнопки банка по той же заявке игнорируем столько секунд
+ACTION_LOCK_TTL = int(os.getenv("ACTION_LOCK_TTL", "5"))
+
+# Антиспам: сколько апдейтов в секунду принимаем от одного пользователя
+RATE_LIMIT_PER_SEC = int(os.getenv("RATE_LIMIT_PER_SEC", "5"))
+
+# Исходящая очередь: лимиты Telegram ~30 msg/s на бота и ~1 msg/s на чат
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "25"))  # воркеров отправки
+SEND_RATE_GLOBAL = float(os.getenv("SEND_RATE_GLOBAL", "30"))   # msg/s на бота
+SEND_RATE_PER_CHAT = float(os.getenv("SEND_RATE_PER_CHAT", "1"))  # msg/s на чат
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "10000"))
+
+# Входящие апдейты: вебхук кладёт в очередь, обрабатывает пул воркеров
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "50"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+
+# Имя клиента — свободный ввод; ограничиваем, чтобы списки заявок влезали в сообщение
+CLIENT_NAME_MAX = 64
+# Order.summary() с учётом CLIENT_NAME_MAX и обрезки полей — не больше ~300 символов,
+# поэтому в одно сообщение (лимит Telegram — 4096) кладём не больше 12 заявок.
+# Сколько последних заявок показывать клиенту в /mytrades
+MY_TRADES_LIMIT = min(int(os.getenv("MY_TRADES_LIMIT", "10")), 12)
+# Заявок на странице «Все заявки»
+BANK_PAGE_SIZE = min(int(os.getenv("BANK_PAGE_SIZE", "10")), 12)
+
 # ===================== LOGGING =====================
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | fxbank_bot | %(message)s",
-)
+class _CachedTimeFormatter(logging.Formatter):
+    """strftime для asctime считается раз в секунду, миллисекунды дописываются."""
+    _sec = -1
+    _stamp = ""
+
+    def formatTime(self, record, datefmt=None):
+        sec = int(record.created)
+        if sec != self._sec:
+            self._sec = sec
+            self._stamp = time.strftime(self.default_time_format, self.converter(record.created))
+        return self.default_msec_format % (self._stamp, record.msecs)
+
+# Хендлеры пишут только в очередь; форматирование и I/O — в потоке QueueListener,
+# так что медленный stderr/лог-драйвер не блокирует event loop.
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(_CachedTimeFormatter("%(asctime)s | %(levelname)s | fxbank_bot | %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_enqueue = logging.handlers.QueueHandler(_log_queue)
+_log_enqueue.setFormatter(logging.Formatter("%(message)s"))  # иначе basicConfig навесит свой формат
+logging.basicConfig(level=logging.INFO, handlers=[_log_enqueue])
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger("fxbank_bot")
 
-# ===================== FASTAPI =====================
-app = FastAPI(title="FXBankBot", version="2.0.1")
-
 # ===================== REDIS (FSM) =====================
 try:
-    redis_conn = redis.from_url(REDIS_URL)
-    storage = RedisStorage(redis_conn)
-    logger.info("RedisStorage initialized.")
+    # Один пул на FSM и на прочие команды; decode_responses — строки декодирует
+    # сам парсер (hiredis, если установлен — см. requirements)
+    # Blocking-пул: при пике запросы ждут соединение, а не падают с "Too many connections"
+    redis_pool = redis.BlockingConnectionPool.from_url(
+        REDIS_URL,
+        max_connections=REDIS_POOL,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        socket_keepalive=True,
+        health_check_interval=15,
+        retry_on_timeout=True,
+        encoding="utf-8",
+        decode_responses=True,
+    )
+    redis_conn = redis.Redis(connection_pool=redis_pool)
+    storage = RedisStorage(redis_conn, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+    if not HIREDIS_AVAILABLE:
+        logger.warning("hiredis not installed: Redis replies are parsed in pure Python.")
+    logger.info(
+        "RedisStorage initialized (parser: %s, pool=%s, fsm_ttl=%s).",
+        "hiredis" if HIREDIS_AVAILABLE else "python", REDIS_POOL, FSM_TTL,
+    )
 except Exception as e:
-    logger.error(f"Redis init failed: {e}")
+    logger.error("Redis init failed: %s", e)
     raise
 
 # ===================== AIROGRAM CORE =====================
+# Держим TLS-соединения к api.telegram.org живыми между вызовами (рассылки, ответы).
+# Остальное (limit=100, ttl_dns_cache) — дефолты aiohttp: живые соединения DNS не перерезолвят.
+# Внимание: _connector_init — приватный атрибут AiohttpSession (в 3.7 иначе параметры
+# TCPConnector не задать); при обновлении aiogram проверить, что он ещё есть.
+tg_session = AiohttpSession()
+tg_session._connector_init.update(keepalive_timeout=75)
+
 bot = Bot(
     token=BOT_TOKEN,
+    session=tg_session,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML),
 )
-dp = Dispatcher(storage=storage)
+class ChatEventIsolation(BaseEventIsolation):
+    """
+    Апдейты одного чата обрабатываются по очереди, разных чатов — параллельно.
+    В отличие от SimpleEventIsolation, замки простаивающих чатов удаляются.
+    """
+
+    def __init__(self):
+        self._locks: Dict[StorageKey, asyncio.Lock] = {}
+        self._holders: Dict[StorageKey, int] = {}
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._holders[key] = self._holders.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._holders[key] -= 1
+            if not self._holders[key]:
+                del self._holders[key]
+                del self._locks[key]
+
+    async def close(self):
+        self._locks.clear()
+        self._holders.clear()
+
+# Замок берётся в FSMContextMiddleware до чтения состояния из Redis.
+# Локальный замок защищает только внутри процесса; при нескольких воркерах — замок в Redis.
+dp = Dispatcher(
+    storage=storage,
+    events_isolation=storage.create_isolation() if WEB_CONCURRENCY > 1 else ChatEventIsolation(),
+)
 router = Router()
 dp.include_router(router)
 
@@ -82,14 +224,17 @@ dp.include_router(router)
 class UpdateLoggingMiddleware(BaseMiddleware):
     async def __call__(self, handler, event, data):
         # Это middleware на уровне Update
+        # Сериализация апдейта дорогая — только если INFO реально пишется
+        if not logger.isEnabledFor(logging.INFO):
+            return await handler(event, data)
         try:
             # event тут — aiogram.types.Update
             raw = ""
             with suppress(Exception):
                 raw = event.model_dump_json()[:600]
-            logger.info(f"RAW UPDATE: {raw}")
+            logger.info("RAW UPDATE: %s", raw)
         except Exception as e:
-            logger.warning(f"UpdateLoggingMiddleware error: {e}")
+            logger.warning("UpdateLoggingMiddleware error: %s", e)
         return await handler(event, data)
 
 class EventLoggingMiddleware(BaseMiddleware):
@@ -97,119 +242,273 @@ class EventLoggingMiddleware(BaseMiddleware):
         # Это middleware для message/callback уровней
         try:
             if isinstance(event, types.Message):
-                state = None
-                if "state" in data:
-                    with suppress(Exception):
-                        state = await data["state"].get_state()
+                # raw_state уже прочитан FSMContextMiddleware (outer на уровне update)
+                state = data.get("raw_state")
                 logger.info(
-                    f"MSG from {event.from_user.id} @{event.from_user.username}: "
-                    f"text={repr(event.text)} state={state}"
+                    "MSG from %s @%s: text=%r state=%s",
+                    event.from_user.id, event.from_user.username, event.text, state,
                 )
             elif isinstance(event, types.CallbackQuery):
                 logger.info(
-                    f"CB from {event.from_user.id} @{event.from_user.username}: data={repr(event.data)}"
+                    "CB from %s @%s: data=%r", event.from_user.id, event.from_user.username, event.data,
                 )
         except Exception as e:
-            logger.warning(f"EventLoggingMiddleware error: {e}")
+            logger.warning("EventLoggingMiddleware error: %s", e)
         return await handler(event, data)
 
+# INCR + EXPIRE за один round-trip: счётчик окна живёт ровно одну секунду
+_RATE_LIMIT_LUA = """
+local n = redis.call('INCR', KEYS[1])
+if n == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return n
+"""
+
+class RateLimitMiddleware(BaseMiddleware):
+    """
+    Отбрасывает апдейты пользователя сверх limit в секунду (общий счётчик в Redis).
+    Outer-middleware на Update: работает уже после FSMContextMiddleware, т.е. под
+    замком чата и после чтения состояния — экономит только хендлер и логи.
+    """
+
+    def __init__(self, r: redis.Redis, limit: int):
+        self.limit = limit
+        self._incr = r.register_script(_RATE_LIMIT_LUA)
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and self.limit > 0:
+            key = f"fxbank:rl:{user.id}:{int(time.time())}"
+            try:
+                hits = await self._incr(keys=[key], args=[1])
+            except Exception as e:
+                # Redis недоступен — не блокируем пользователей
+                logger.warning("RateLimitMiddleware error: %s", e)
+            else:
+                if hits > self.limit:
+                    logger.info("Rate limited %s: %s updates/s", user.id, hits)
+                    # Без ответа у пользователя «часики» на кнопке висят до таймаута Telegram
+                    if event.callback_query is not None:
+                        safe_cb_answer(event.callback_query)
+                    return None
+        return await handler(event, data)
+
+class ErrorMiddleware(BaseMiddleware):
+    """Единая обработка исключений хендлеров: лог + короткий ответ пользователю."""
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_obj = data.get("handler")
+            name = getattr(getattr(handler_obj, "callback", None), "__name__", "handler")
+            if isinstance(event, types.CallbackQuery):
+                # Все callback'и идут через cq_dispatch — называем реальный обработчик из CB_DISPATCH
+                kind = (event.data or "").partition(":")[0]
+                target = CB_DISPATCH.get(kind)
+                if isinstance(target, partial):
+                    name = f"{target.func.__name__}[{kind}]"
+                elif target is not None:
+                    name = target.__name__
+                logger.exception("%s failed (data=%r)", name, event.data)
+                safe_cb_answer(event, "⚠️ Ошибка", show_alert=True)
+            else:
+                logger.exception("%s failed (text=%r)", name, getattr(event, "text", None))
+                with suppress(Exception):
+                    await event.answer("⚠️ Внутренняя ошибка. Попробуйте ещё раз.")
+
+# Антиспам — до логирования, чтобы флуд не раздувал логи (замок чата и GET состояния уже позади)
+dp.update.outer_middleware(RateLimitMiddleware(redis_conn, RATE_LIMIT_PER_SEC))
 # Вешаем логирование и на Update, и на конкретные типы событий
 dp.update.outer_middleware(UpdateLoggingMiddleware())
 dp.message.outer_middleware(EventLoggingMiddleware())
 dp.callback_query.outer_middleware(EventLoggingMiddleware())
+# Inner-middleware: оборачивает только вызов найденного хендлера
+dp.message.middleware(ErrorMiddleware())
+dp.callback_query.middleware(ErrorMiddleware())
 
 # ===================== RUNTIME STORAGE =====================
-user_roles: Dict[int, str] = {}  # user_id -> "client" | "bank"
+BANKS_KEY = "fxbank:banks"  # Redis SET с user_id банков; остальные — клиенты
+
+# Пояснение к сумме в конверсии по amount_side
+_AMOUNT_SIDE_TXT = {"sell": " (сумма продажи)", "buy": " (сумма покупки)"}
 
+_SUMMARY_FMT = (
+    "📌 <b>Заявка #{id}</b>\n"
+    "👤 Клиент: {client_name}{tg}\n"
+    "💱 Операция: {line}\n"
+    "📊 Курс клиента (BASE/QUOTE): {rate}\n"
+    "📍 Статус: {status}"
+)
+
+@dataclass(slots=True)
 class Order:
-    counter = 0
-
-    def __init__(
-        self,
-        client_id: int,
-        client_telegram: str,
-        client_name: str,
-        operation: str,              # "покупка" | "продажа" | "конвертация"
-        amount: float,
-        currency_from: str,
-        currency_to: Optional[str],  # UAH для buy/sell; валюта для convert
-        rate: float,                 # курс клиента BASE/QUOTE
-        amount_side: Optional[str] = None,  # для convert: "sell"|"buy"
-    ):
-        Order.counter += 1
-        self.id = Order.counter
-        self.client_id = client_id
-        self.client_telegram = client_telegram
-        self.client_name = client_name
-        self.operation = operation
-        self.amount = amount
-        self.currency_from = currency_from
-        self.currency_to = currency_to
-        self.rate = rate
-        self.amount_side = amount_side
-        self.status = "new"          # new | accepted | rejected | order
+    id: int
+    client_id: int
+    client_telegram: str
+    client_name: str
+    operation: str              # "покупка" | "продажа" | "конвертация"
+    amount: float
+    currency_from: str
+    currency_to: Optional[str]  # UAH для buy/sell; валюта для convert
+    rate: float                 # курс клиента BASE/QUOTE
+    amount_side: Optional[str] = None  # для convert: "sell"|"buy"
+    status: str = "new"         # new | accepted | rejected | order
+
+    def to_redis(self) -> Dict[str, object]:
+        # None-поля в hash не пишем — from_redis вернёт их как None
+        values = ((k, getattr(self, k)) for k in self.__slots__)
+        return {k: v for k, v in values if v is not None}
+
+    @classmethod
+    def from_redis(cls, data: Dict[str, str]) -> "Order":
+        return cls(
+            id=int(data["id"]),
+            client_id=int(data["client_id"]),
+            client_telegram=data.get("client_telegram", ""),
+            client_name=data.get("client_name", ""),
+            operation=data["operation"],
+            amount=float(data["amount"]),
+            currency_from=data["currency_from"],
+            currency_to=data.get("currency_to"),
+            rate=float(data["rate"]),
+            amount_side=data.get("amount_side"),
+            status=data.get("status", "new"),
+        )
 
     def summary(self) -> str:
+        # Пользовательские поля: обрезаем (старые заявки могли быть без лимитов) и экранируем —
+        # parse_mode HTML, а «<» в имени ломает всё сообщение, включая страницу банка
+        cfrom = html.escape((self.currency_from or "")[:8])
         if self.operation == "конвертация":
-            side_txt = (
-                " (сумма продажи)"
-                if self.amount_side == "sell"
-                else (" (сумма покупки)" if self.amount_side == "buy" else "")
-            )
-            line = f"{self.amount} {self.currency_from} → {self.currency_to}{side_txt}"
+            side_txt = _AMOUNT_SIDE_TXT.get(self.amount_side, "")
+            cto = html.escape((self.currency_to or "")[:8])
+            line = f"{self.amount} {cfrom} → {cto}{side_txt}"
         else:
-            line = f"{self.operation} {self.amount} {self.currency_from} (против UAH)"
-        tg = f" (@{self.client_telegram})" if self.client_telegram else ""
-        return (
-            f"📌 <b>Заявка #{self.id}</b>\n"
-            f"👤 Клиент: {self.client_name}{tg}\n"
-            f"💱 Операция: {line}\n"
-            f"📊 Курс клиента (BASE/QUOTE): {self.rate}\n"
-            f"📍 Статус: {self.status}"
+            line = f"{self.operation} {self.amount} {cfrom} (против UAH)"
+        tg = f" (@{html.escape(self.client_telegram[:32])})" if self.client_telegram else ""
+        return _SUMMARY_FMT.format(
+            id=self.id, client_name=html.escape(self.client_name[:CLIENT_NAME_MAX]), tg=tg,
+            line=line, rate=self.rate, status=self.status,
         )
 
-orders: Dict[int, Order] = {}
+# ===================== ORDER STORE (Redis) =====================
+# Заявка — hash fxbank:order:<id>; индексы — ZSET со score = id (общий и по клиенту),
+# так что сортировка и limit выполняются на стороне Redis.
+ORDER_SEQ_KEY = "fxbank:order:seq"
+ORDERS_INDEX_KEY = "fxbank:orders:index"
+ORDER_KEY_PREFIX = "fxbank:order:"
+ORDER_EVENTS_KEY = "fxbank:orders:events"
+ORDER_EVENTS_MAXLEN = 10000
+
+def order_key(oid: int) -> str:
+    return f"{ORDER_KEY_PREFIX}{oid}"
+
+def client_orders_key(client_id: int) -> str:
+    return f"fxbank:orders:client:{client_id}"
+
+# INCR id + HSET + оба индекса + событие в stream — атомарно и за один round-trip.
+# id выдаёт Redis, так что несколько воркеров uvicorn не пересекаются.
+# KEYS: seq, общий индекс, индекс клиента, stream событий
+# ARGV: префикс ключа заявки, maxlen stream'а, затем пары поле/значение
+_ORDER_CREATE_LUA = """
+local id = redis.call('INCR', KEYS[1])
+redis.call('HSET', ARGV[1] .. id, 'id', id, unpack(ARGV, 3))
+redis.call('ZADD', KEYS[2], id, id)
+redis.call('ZADD', KEYS[3], id, id)
+redis.call('XADD', KEYS[4], 'MAXLEN', '~', ARGV[2], '*', 'id', id)
+return id
+"""
+_order_create = redis_conn.register_script(_ORDER_CREATE_LUA)
+
+async def order_create(**fields) -> Order:
+    """Создаёт заявку и публикует событие для рассылки банкам (см. order_events_consumer)."""
+    order = Order(id=0, **fields)
+    args = [ORDER_KEY_PREFIX, ORDER_EVENTS_MAXLEN]
+    for k, v in order.to_redis().items():
+        if k != "id":
+            args += (k, v)
+    order.id = int(await _order_create(
+        keys=[ORDER_SEQ_KEY, ORDERS_INDEX_KEY, client_orders_key(order.client_id), ORDER_EVENTS_KEY],
+        args=args,
+    ))
+    return order
+
+async def order_get(oid: int) -> Optional[Order]:
+    data = await redis_conn.hgetall(order_key(oid))
+    return Order.from_redis(data) if data else None
+
+async def orders_load(ids) -> List[Order]:
+    """Все HGETALL одним pipeline — один round-trip на любое число заявок."""
+    if not ids:
+        return []
+    pipe = redis_conn.pipeline(transaction=False)
+    for oid in ids:
+        pipe.hgetall(order_key(int(oid)))
+    return [Order.from_redis(row) for row in await pipe.execute() if row]
+
+# Смена статуса и чтение обновлённой заявки за один round-trip; несуществующую не создаём
+# ARGV — пары поле/значение (status + доп. поля); проверка, запись и чтение — атомарно
+_ORDER_SET_STATUS_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return nil end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return redis.call('HGETALL', KEYS[1])
+"""
+_order_set_status = redis_conn.register_script(_ORDER_SET_STATUS_LUA)
+
+async def order_set_status(oid: int, status: str, **patch) -> Optional[Order]:
+    args = ["status", status]
+    for k, v in patch.items():
+        if v is not None:
+            args += (k, v)
+    flat = await _order_set_status(keys=[order_key(oid)], args=args)
+    if not flat:
+        return None
+    return Order.from_redis(dict(zip(flat[::2], flat[1::2])))
 
 # ===================== KEYBOARDS =====================
-def kb_main_client() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="➕ Новая заявка")],
-            [KeyboardButton(text="🗂 Мои заявки"), KeyboardButton(text="💱 Курсы")],
-        ],
-        resize_keyboard=True,
-    )
+# Клавиатуры неизменяемые — собираем один раз и переиспользуем
+KB_MAIN_CLIENT = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="➕ Новая заявка")],
+        [KeyboardButton(text="🗂 Мои заявки"), KeyboardButton(text="💱 Курсы")],
+    ],
+    resize_keyboard=True,
+)
 
-def kb_main_bank() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="📋 Все заявки")],
-            [KeyboardButton(text="💱 Курсы")],
-        ],
-        resize_keyboard=True,
-    )
+KB_MAIN_BANK = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📋 Все заявки")],
+        [KeyboardButton(text="💱 Курсы")],
+    ],
+    resize_keyboard=True,
+)
 
-def ikb_role() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="👤 Я клиент", callback_data="role:client"),
-            InlineKeyboardButton(text="🏦 Я банк", callback_data="role:bank"),
-        ]
-    ])
+IKB_ROLE = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="👤 Я клиент", callback_data="role:client"),
+        InlineKeyboardButton(text="🏦 Я банк", callback_data="role:bank"),
+    ]
+])
 
-def ikb_deal_type() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Купить валюту", callback_data="deal:buy")],
-        [InlineKeyboardButton(text="Продать валюту", callback_data="deal:sell")],
-        [InlineKeyboardButton(text="Конверсия (валюта→валюта)", callback_data="deal:convert")],
-    ])
+IKB_DEAL_TYPE = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Купить валюту", callback_data="deal:buy")],
+    [InlineKeyboardButton(text="Продать валюту", callback_data="deal:sell")],
+    [InlineKeyboardButton(text="Конверсия (валюта→валюта)", callback_data="deal:convert")],
+])
 
-def ikb_amount_side() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Ввожу сумму ПРОДАЖИ (BASE)", callback_data="as:sell")],
-        [InlineKeyboardButton(text="Ввожу сумму ПОКУПКИ (QUOTE)", callback_data="as:buy")],
-    ])
+IKB_AMOUNT_SIDE = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Ввожу сумму ПРОДАЖИ (BASE)", callback_data="as:sell")],
+    [InlineKeyboardButton(text="Ввожу сумму ПОКУПКИ (QUOTE)", callback_data="as:buy")],
+])
 
+# Роль -> главное меню (user_role возвращает "bank" | "client")
+KB_BY_ROLE = {"bank": KB_MAIN_BANK, "client": KB_MAIN_CLIENT}
+
+# Тексты кнопок reply-меню — для единого фильтра F.text.in_ (см. menu_button)
+MENU_BUTTONS = frozenset(b.text for kb in (KB_MAIN_CLIENT, KB_MAIN_BANK) for row in kb.keyboard for b in row)
+
+@lru_cache(maxsize=4096)
 def ikb_bank_order(order_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -221,411 +520,717 @@ def ikb_bank_order(order_id: int) -> InlineKeyboardMarkup:
         ]
     ])
 
+def ikb_bank_page(order_ids: List[int], page: int, has_next: bool) -> InlineKeyboardMarkup:
+    """Страница списка банка: кнопки #id (по 5 в ряд) и навигация."""
+    rows = [
+        [InlineKeyboardButton(text=f"#{oid}", callback_data=f"pick:{oid}") for oid in order_ids[i:i + 5]]
+        for i in range(0, len(order_ids), 5)
+    ]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"page:{page - 1}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"page:{page + 1}"))
+    if nav:
+        rows.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
 # ===================== RATES (STUB) =====================
+STUB_RATES: Dict[str, float] = {
+    "USD/UAH": 41.25,
+    "EUR/UAH": 45.10,
+    "PLN/UAH": 10.60,
+    "EUR/USD": 1.0920,
+    "USD/PLN": 3.8760,
+    "EUR/PLN": 4.2326,
+}
+
 def get_stub_rates() -> Dict[str, float]:
     # Позже подключим поставщика (LSEG/Bloomberg)
-    return {
-        "USD/UAH": 41.25,
-        "EUR/UAH": 45.10,
-        "PLN/UAH": 10.60,
-        "EUR/USD": 1.0920,
-        "USD/PLN": 3.8760,
-        "EUR/PLN": 4.2326,
-    }
+    return STUB_RATES
 
 def format_rates_text() -> str:
     r = get_stub_rates()
-    return "\n".join([f"{k} = {v}" for k, v in r.items()])
+    return "\n".join(f"{k} = {v}" for k, v in r.items())
+
+# Заглушка не меняется — текст для /rate собираем один раз при импорте
+RATES_TEXT = "💱 Текущие курсы (заглушка):\n" + format_rates_text()
 
 # ===================== HELPERS =====================
-def user_role(uid: int) -> str:
-    return user_roles.get(uid, "client")
+# Положительное число, дробная часть через точку или запятую
+_NUM_RE = re.compile(r"^\s*(\d{1,18}(?:[.,]\d{1,8})?)\s*$")
+
+# Код валюты: 3–4 латинские буквы (USD, EUR, USDT); «AB1» или «доллар» не пропускаем
+_CCY_RE = re.compile(r"\A[A-Z]{3,4}\Z")
+
+# Курсы и суммы в чатах часто повторяются (41.25, 1000) — повторный ввод берём из кэша
+@lru_cache(maxsize=1024)
+def parse_number(text: Optional[str]) -> Optional[float]:
+    """Сумма/курс из ввода пользователя или None, если это не число."""
+    m = _NUM_RE.match(text or "")
+    if not m:
+        return None
+    return float(m.group(1).replace(",", "."))
+
+_role_cache: Dict[int, Tuple[float, str]] = {}  # user_id -> (expires_at, role)
+
+def _cache_role(uid: int, role: str):
+    now = time.monotonic()
+    if len(_role_cache) > 4096:
+        for k in [k for k, (exp, _) in _role_cache.items() if exp <= now]:
+            del _role_cache[k]
+    _role_cache[uid] = (now + ROLE_CACHE_TTL, role)
+
+async def user_role(uid: int) -> str:
+    cached = _role_cache.get(uid)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    role = "bank" if await redis_conn.sismember(BANKS_KEY, uid) else "client"
+    _cache_role(uid, role)
+    return role
+
+# Локальная копия fxbank:banks для рассылки новых заявок: не ходим в Redis на каждую пачку.
+# Свои изменения применяем сразу, чужие (другие воркеры) подтягивает bank_ids_refresher.
+bank_ids: Set[int] = set()
+# False, пока bank_ids ни разу не загрузился: пустое множество ещё не значит «банков нет»
+bank_ids_loaded = False
+
+async def set_user_role(uid: int, role: str):
+    if role == "bank":
+        await redis_conn.sadd(BANKS_KEY, uid)
+        bank_ids.add(uid)
+    else:
+        await redis_conn.srem(BANKS_KEY, uid)
+        bank_ids.discard(uid)
+    _cache_role(uid, role)
+
+async def refresh_bank_ids():
+    global bank_ids_loaded
+    fresh = {int(uid) for uid in await redis_conn.smembers(BANKS_KEY)}
+    bank_ids.clear()
+    bank_ids.update(fresh)
+    bank_ids_loaded = True
+
+async def bank_ids_refresher():
+    while True:
+        await asyncio.sleep(BANK_IDS_REFRESH)
+        try:
+            await refresh_bank_ids()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Redis недоступен — работаем со старым множеством
+            logger.warning("bank_ids refresh failed: %s", e)
+
+_cb_answer_tasks: Set[asyncio.Task] = set()
 
-async def safe_cb_answer(cb: CallbackQuery, text: Optional[str] = None, show_alert: bool = False):
+async def _cb_answer(cb: CallbackQuery, text: Optional[str], show_alert: bool):
     with suppress(Exception):
         await cb.answer(text, show_alert=show_alert)
 
+def safe_cb_answer(cb: CallbackQuery, text: Optional[str] = None, show_alert: bool = False):
+    """Ответ на callback фоном: answerCallbackQuery не блокирует edit/отправку следом.
+
+    Вызывать до edit/answer, как только известен результат, — иначе «часики» у
+    пользователя висят ещё один RTT до Telegram.
+    """
+    task = asyncio.create_task(_cb_answer(cb, text, show_alert))
+    _cb_answer_tasks.add(task)
+    task.add_done_callback(_cb_answer_tasks.discard)
+
+async def claim_callback(cb: CallbackQuery, action_key: Optional[str] = None) -> bool:
+    """
+    SET NX по callback.id: повторная доставка того же нажатия вернёт False.
+    С action_key — ещё и короткий замок на действие: новые нажатия той же кнопки
+    (у них другой callback.id) в течение ACTION_LOCK_TTL тоже вернут False.
+    """
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.set(f"fxbank:cb:{cb.id}", 1, ex=60, nx=True)
+        if action_key:
+            pipe.set(f"fxbank:lock:{action_key}", 1, ex=ACTION_LOCK_TTL, nx=True)
+        return all(await pipe.execute())
+    except Exception as e:
+        # Redis недоступен — лучше обработать дубль, чем потерять нажатие
+        logger.warning("claim_callback error: %s", e)
+        return True
+
+# --- FSM: меньше round-trip'ов к Redis ---
+# update_data() — это GET+SET, set_state() — ещё SET, clear() — два DEL.
+# Здесь: максимум один GET data и один pipeline на запись.
+def _fsm_keys(state: FSMContext) -> Tuple[str, str]:
+    kb = state.storage.key_builder
+    return kb.build(state.key, "state"), kb.build(state.key, "data")
+
+async def fsm_commit(state: FSMContext, new_state: State, data: Dict[str, Any], **updates) -> Dict[str, Any]:
+    """Сливает updates в уже прочитанную data и пишет data + state одним pipeline."""
+    data.update(updates)
+    st = state.storage
+    state_key, data_key = _fsm_keys(state)
+    async with st.redis.pipeline(transaction=True) as pipe:
+        if data:
+            pipe.set(data_key, st.json_dumps(data), ex=st.data_ttl)
+        pipe.set(state_key, new_state.state, ex=st.state_ttl)
+        await pipe.execute()
+    return data
+
+async def fsm_advance(state: FSMContext, new_state: State, **updates) -> Dict[str, Any]:
+    return await fsm_commit(state, new_state, await state.get_data(), **updates)
+
+async def fsm_reset(state: FSMContext, new_state: Optional[State] = None):
+    """clear() и, если задано, set_state(new_state) одним pipeline."""
+    st = state.storage
+    state_key, data_key = _fsm_keys(state)
+    async with st.redis.pipeline(transaction=True) as pipe:
+        pipe.delete(data_key)
+        if new_state is None:
+            pipe.delete(state_key)
+        else:
+            pipe.set(state_key, new_state.state, ex=st.state_ttl)
+        await pipe.execute()
+
+# ===================== OUTGOING QUEUE =====================
+# Уведомления (банкам, клиентам) не шлём из хендлеров напрямую: кладём в очередь,
+# которую разбирают sender_worker'ы с соблюдением лимитов Telegram.
+class TokenBucket:
+    """rate токенов в секунду, запас до capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Берёт токен (можно в долг) и возвращает, сколько секунд подождать."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+send_queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+_global_bucket = TokenBucket(SEND_RATE_GLOBAL, SEND_RATE_GLOBAL)
+_chat_buckets: Dict[int, TokenBucket] = {}
+
+def _chat_bucket(chat_id: int) -> TokenBucket:
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        if len(_chat_buckets) > 4096:
+            for k in [k for k, b in _chat_buckets.items() if b.idle()]:
+                del _chat_buckets[k]
+        bucket = _chat_buckets[chat_id] = TokenBucket(SEND_RATE_PER_CHAT, 3)
+    return bucket
+
+# Flood wait от Telegram действует на весь бот: до этого момента (monotonic) не шлёт ни один воркер
+_send_paused_until = 0.0
+SEND_MAX_ATTEMPTS = 3
+
+def enqueue_message(chat_id: int, text: str, **kwargs) -> bool:
+    try:
+        send_queue.put_nowait((chat_id, text, kwargs))
+        return True
+    except asyncio.QueueFull:
+        logger.warning("Send queue full, dropping message to %s", chat_id)
+        return False
+
+async def _send_with_retry(chat_id: int, text: str, kwargs: Dict[str, Any]):
+    global _send_paused_until
+    # Сначала очередь чата, потом общий лимит — чтобы не держать общий токен зря
+    await asyncio.sleep(_chat_bucket(chat_id).reserve())
+    for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
+        pause = _send_paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        await asyncio.sleep(_global_bucket.reserve())
+        try:
+            return await bot.send_message(chat_id, text, **kwargs)
+        except TelegramRetryAfter as e:
+            if attempt == SEND_MAX_ATTEMPTS:
+                raise
+            logger.warning("Flood control: pausing sends for %ss (chat %s)", e.retry_after, chat_id)
+            _send_paused_until = max(_send_paused_until, time.monotonic() + e.retry_after)
+
+async def sender_worker():
+    while True:
+        chat_id, text, kwargs = await send_queue.get()
+        try:
+            await _send_with_retry(chat_id, text, kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("send to %s failed: %s", chat_id, e)
+        finally:
+            send_queue.task_done()
+
+def notify_banks(order_id: int, summary: str, recipients: Tuple[int, ...]) -> bool:
+    """
+    Ставит новую заявку в очередь отправки каждому банку.
+    False — в очереди нет места на всех получателей; тогда не ставится ничего,
+    чтобы повторная обработка события не дублировала уже поставленные сообщения.
+    """
+    if send_queue.maxsize - send_queue.qsize() < len(recipients):
+        logger.warning("Send queue full, order %s notification postponed", order_id)
+        return False
+    text = "📥 Новая заявка:\n\n" + summary
+    kb = ikb_bank_order(order_id)
+    for uid in recipients:
+        enqueue_message(uid, text, reply_markup=kb)
+    return True
+
 # ===================== COMMANDS & COMMON =====================
+# Статичные подсказки — одна строка на модуль, а не новый литерал в каждом хендлере
+START_TEXT = "👋 Добро пожаловать в FXBankBot!\nВыберите роль:"
+
 @router.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
-    try:
-        await state.clear()
-        user_roles[message.from_user.id] = user_roles.get(message.from_user.id, "client")
-        await message.answer("👋 Добро пожаловать в FXBankBot!\nВыберите роль:", reply_markup=ikb_role())
-    except Exception as e:
-        logger.error(f"/start failed: {e}")
-        await message.answer("⚠️ Ошибка при /start")
+    await fsm_reset(state)
+    await message.answer(START_TEXT, reply_markup=IKB_ROLE)
 
 @router.message(Command("menu"))
 async def cmd_menu(message: Message):
-    try:
-        role = user_role(message.from_user.id)
-        kb = kb_main_bank() if role == "bank" else kb_main_client()
-        await message.answer("📍 Главное меню:", reply_markup=kb)
-    except Exception as e:
-        logger.error(f"/menu failed: {e}")
-        await message.answer("⚠️ Ошибка при отображении меню.")
+    kb = KB_BY_ROLE[await user_role(message.from_user.id)]
+    await message.answer("📍 Главное меню:", reply_markup=kb)
 
 @router.message(Command("rate"))
-@router.message(F.text == "💱 Курсы")
-async def cmd_rate(message: Message):
-    try:
-        await message.answer("💱 Текущие курсы (заглушка):\n" + format_rates_text())
-    except Exception as e:
-        logger.error(f"/rate failed: {e}")
-        await message.answer("⚠️ Не удалось получить курсы.")
+async def cmd_rate(message: Message, state: FSMContext):
+    await message.answer(RATES_TEXT)
+
+# Кнопки меню: один фильтр по frozenset и поиск в MENU_DISPATCH вместо цепочки F.text == ...
+# Регистрируется до FSM-хендлеров, чтобы кнопки работали и посреди сценария.
+@router.message(F.text.in_(MENU_BUTTONS))
+async def menu_button(message: Message, state: FSMContext):
+    await MENU_DISPATCH[message.text](message, state)
 
 @router.message(Command("cancel"))
-async def cmd_cancel(message: Message, state: FSMContext):
-    try:
-        cur = await state.get_state()
-        await state.clear()
-        role = user_role(message.from_user.id)
-        kb = kb_main_bank() if role == "bank" else kb_main_client()
-        if cur:
-            await message.answer("✅ Действие отменено. Главное меню:", reply_markup=kb)
-        else:
-            await message.answer("❌ Нет активного действия. Главное меню:", reply_markup=kb)
-    except Exception as e:
-        logger.error(f"/cancel failed: {e}")
-        await message.answer("⚠️ Ошибка отмены.")
+async def cmd_cancel(message: Message, state: FSMContext, raw_state: Optional[str]):
+    # raw_state уже прочитан FSMContextMiddleware — не ходим в Redis повторно
+    cur = raw_state
+    await fsm_reset(state)
+    kb = KB_BY_ROLE[await user_role(message.from_user.id)]
+    if cur:
+        await message.answer("✅ Действие отменено. Главное меню:", reply_markup=kb)
+    else:
+        await message.answer("❌ Нет активного действия. Главное меню:", reply_markup=kb)
 
 @router.message(Command("bank"))
-async def cmd_bank(message: Message):
-    try:
-        parts = (message.text or "").strip().split(maxsplit=1)
-        if len(parts) < 2:
-            return await message.answer("❌ Укажите пароль: /bank <пароль>")
-        if parts[1] == BANK_PASSWORD:
-            user_roles[message.from_user.id] = "bank"
-            await message.answer("🏦 Успешный вход. Вы вошли как банк.", reply_markup=kb_main_bank())
-        else:
-            await message.answer("❌ Неверный пароль.")
-    except Exception as e:
-        logger.error(f"/bank failed: {e}")
-        await message.answer("⚠️ Ошибка входа банка.")
-
-@router.callback_query(F.data.startswith("role:"))
-async def cq_role(callback: CallbackQuery):
-    try:
-        _, role = callback.data.split(":")
-        if role not in ("client", "bank"):
-            return await safe_cb_answer(callback, "Неизвестная роль", show_alert=True)
-        user_roles[callback.from_user.id] = role
-        if role == "bank":
-            await callback.message.edit_text("Роль установлена: 🏦 Банк")
-            await callback.message.answer("Меню банка:", reply_markup=kb_main_bank())
-        else:
-            await callback.message.edit_text("Роль установлена: 👤 Клиент")
-            await callback.message.answer("Меню клиента:", reply_markup=kb_main_client())
-        await safe_cb_answer(callback)
-    except Exception as e:
-        logger.error(f"cq_role failed: {e}")
-        await safe_cb_answer(callback, "Ошибка", show_alert=True)
+async def cmd_bank(message: Message, command: CommandObject):
+    # Аргументы уже разобраны фильтром Command — текст повторно не режем
+    password = (command.args or "").strip()
+    if not password:
+        return await message.answer("❌ Укажите пароль: /bank <пароль>")
+    if password == BANK_PASSWORD:
+        await set_user_role(message.from_user.id, "bank")
+        await message.answer("🏦 Успешный вход. Вы вошли как банк.", reply_markup=KB_MAIN_BANK)
+    else:
+        await message.answer("❌ Неверный пароль.")
+
+# role:<роль> -> (текст подтверждения, заголовок меню)
+_ROLE_SCREENS = {
+    "bank": ("Роль установлена: 🏦 Банк", "Меню банка:"),
+    "client": ("Роль установлена: 👤 Клиент", "Меню клиента:"),
+}
+
+async def cq_role(callback: CallbackQuery, role: str, state: FSMContext):
+    screen = _ROLE_SCREENS.get(role)
+    if screen is None:
+        return safe_cb_answer(callback, "Неизвестная роль", show_alert=True)
+    await set_user_role(callback.from_user.id, role)
+    confirm, title = screen
+    safe_cb_answer(callback)
+    await callback.message.edit_text(confirm)
+    await callback.message.answer(title, reply_markup=KB_BY_ROLE[role])
 
 # ===================== CLIENT FSM =====================
+# Короткие имена: в Redis лежит "c:r" вместо "ClientFSM:entering_rate".
+# Менять коды нельзя без миграции — активные сессии потеряют состояние.
 class ClientFSM(StatesGroup):
-    entering_client_name = State()
-    choosing_deal = State()
-    entering_currency_from = State()
-    entering_currency_to = State()     # для конверсии
-    choosing_amount_side = State()     # для конверсии: sell/buy
-    entering_amount = State()
-    entering_rate = State()
-
-@router.message(F.text == "➕ Новая заявка")
+    entering_client_name = State("n", group_name="c")
+    choosing_deal = State("d", group_name="c")
+    entering_currency_from = State("cf", group_name="c")
+    entering_currency_to = State("ct", group_name="c")     # для конверсии
+    choosing_amount_side = State("as", group_name="c")     # для конверсии: sell/buy
+    entering_amount = State("a", group_name="c")
+    entering_rate = State("r", group_name="c")
+
+# Старые длинные имена -> короткие коды. FSM-ключи до перехода писались без TTL,
+# так что клиенты посреди сценария иначе навсегда застрянут в неизвестном состоянии.
+_LEGACY_STATES = {
+    f"ClientFSM:{name}": st.state for name, st in vars(ClientFSM).items() if isinstance(st, State)
+}
+
+class LegacyStateMiddleware(BaseMiddleware):
+    """Переписывает состояние старого формата на короткий код до фильтров по состоянию."""
+    async def __call__(self, handler, event, data):
+        new_state = _LEGACY_STATES.get(data.get("raw_state"))
+        if new_state is not None:
+            await data["state"].set_state(new_state)
+            data["raw_state"] = new_state
+        return await handler(event, data)
+
+# raw_state/state кладёт FSMContextMiddleware — он зарегистрирован раньше всех outer-middleware
+dp.update.outer_middleware(LegacyStateMiddleware())
+
+RATE_PROMPT = (
+    "Введите ваш курс (BASE/QUOTE).\n"
+    "Примеры:\n"
+    "• Покупка/Продажа USD против UAH → курс USD/UAH\n"
+    "• Конверсия USD→EUR → курс USD/EUR\n\n"
+    "Можно оставить пусто — подставим заглушку."
+)
+
 async def new_request(message: Message, state: FSMContext):
-    try:
-        await state.clear()
-        await state.set_state(ClientFSM.entering_client_name)
-        await message.answer("👤 Введите ваше имя или название компании:", reply_markup=ReplyKeyboardRemove())
-    except Exception as e:
-        logger.error(f"new_request failed: {e}")
-        await message.answer("⚠️ Ошибка при создании заявки.")
+    await fsm_reset(state, ClientFSM.entering_client_name)
+    await message.answer("👤 Введите ваше имя или название компании:", reply_markup=ReplyKeyboardRemove())
 
 @router.message(ClientFSM.entering_client_name)
 async def fsm_client_name(message: Message, state: FSMContext):
-    try:
-        client_name = (message.text or "").strip()
-        if not client_name:
-            return await message.answer("❌ Введите непустое имя клиента.")
-        await state.update_data(client_name=client_name)
-        await state.set_state(ClientFSM.choosing_deal)
-        await message.answer("Выберите тип сделки:", reply_markup=ikb_deal_type())
-    except Exception as e:
-        logger.error(f"fsm_client_name failed: {e}")
-        await message.answer("⚠️ Ошибка при вводе имени.")
-
-@router.callback_query(F.data.startswith("deal:"))
-async def cq_deal(callback: CallbackQuery, state: FSMContext):
-    try:
-        deal_type = callback.data.split(":")[1]
-        if deal_type == "buy":
-            await state.update_data(operation="покупка", currency_to="UAH")
-        elif deal_type == "sell":
-            await state.update_data(operation="продажа", currency_to="UAH")
-        elif deal_type == "convert":
-            await state.update_data(operation="конвертация")
-        else:
-            return await safe_cb_answer(callback, "❌ Неизвестный тип сделки", show_alert=True)
-
-        await state.set_state(ClientFSM.entering_currency_from)
-        if deal_type == "convert":
-            await callback.message.edit_text("Введите валюту, которую хотите ПРОДАТЬ (пример: USD):")
-        else:
-            await callback.message.edit_text("Введите валюту сделки (пример: USD):")
-        await safe_cb_answer(callback)
-    except Exception as e:
-        logger.error(f"cq_deal failed: {e}")
-        await safe_cb_answer(callback, "⚠️ Ошибка", show_alert=True)
+    client_name = (message.text or "").strip()
+    if not client_name:
+        return await message.answer("❌ Введите непустое имя клиента.")
+    if len(client_name) > CLIENT_NAME_MAX:
+        return await message.answer(f"❌ Слишком длинное имя — не больше {CLIENT_NAME_MAX} символов.")
+    await fsm_advance(state, ClientFSM.choosing_deal, client_name=client_name)
+    await message.answer("Выберите тип сделки:", reply_markup=IKB_DEAL_TYPE)
+
+# deal:<тип> -> (поля FSM, запрос первой валюты)
+_DEALS = {
+    "buy": ({"operation": "покупка", "currency_to": "UAH"}, "Введите валюту сделки (пример: USD):"),
+    "sell": ({"operation": "продажа", "currency_to": "UAH"}, "Введите валюту сделки (пример: USD):"),
+    "convert": ({"operation": "конвертация"}, "Введите валюту, которую хотите ПРОДАТЬ (пример: USD):"),
+}
+
+async def cq_deal(callback: CallbackQuery, arg: str, state: FSMContext):
+    deal = _DEALS.get(arg)
+    if deal is None:
+        return safe_cb_answer(callback, "❌ Неизвестный тип сделки", show_alert=True)
+    fields, prompt = deal
+
+    await fsm_advance(state, ClientFSM.entering_currency_from, **fields)
+    safe_cb_answer(callback)
+    await callback.message.edit_text(prompt)
 
 @router.message(ClientFSM.entering_currency_from)
 async def fsm_currency_from(message: Message, state: FSMContext):
-    try:
-        cfrom = (message.text or "").upper().strip()
-        if not cfrom or len(cfrom) < 3:
-            return await message.answer("❌ Укажите код валюты, пример: USD, EUR, UAH.")
-        await state.update_data(currency_from=cfrom)
-        data = await state.get_data()
-        if data.get("operation") == "конвертация":
-            await state.set_state(ClientFSM.entering_currency_to)
-            await message.answer("Введите валюту, которую хотите ПОЛУЧИТЬ (пример: EUR):")
-        else:
-            await state.update_data(currency_to="UAH")
-            await state.set_state(ClientFSM.entering_amount)
-            await message.answer(f"Введите сумму в {cfrom}:")
-    except Exception as e:
-        logger.error(f"fsm_currency_from failed: {e}")
-        await message.answer("⚠️ Ошибка при вводе валюты.")
+    cfrom = (message.text or "").upper().strip()
+    if not _CCY_RE.match(cfrom):
+        return await message.answer("❌ Укажите код валюты, пример: USD, EUR, UAH.")
+    data = await state.get_data()
+    if data.get("operation") == "конвертация":
+        await fsm_commit(state, ClientFSM.entering_currency_to, data, currency_from=cfrom)
+        await message.answer("Введите валюту, которую хотите ПОЛУЧИТЬ (пример: EUR):")
+    else:
+        await fsm_commit(state, ClientFSM.entering_amount, data, currency_from=cfrom, currency_to="UAH")
+        await message.answer(f"Введите сумму в {cfrom}:")
 
 @router.message(ClientFSM.entering_currency_to)
 async def fsm_currency_to(message: Message, state: FSMContext):
-    try:
-        cto = (message.text or "").upper().strip()
-        if not cto or len(cto) < 3:
-            return await message.answer("❌ Укажите код валюты, пример: USD, EUR.")
-        await state.update_data(currency_to=cto)
-        await state.set_state(ClientFSM.choosing_amount_side)
-        await message.answer("Укажите, какую сумму вводите:", reply_markup=ikb_amount_side())
-    except Exception as e:
-        logger.error(f"fsm_currency_to failed: {e}")
-        await message.answer("⚠️ Ошибка при вводе второй валюты.")
-
-@router.callback_query(F.data.startswith("as:"))
-async def cq_amount_side(callback: CallbackQuery, state: FSMContext):
-    try:
-        side = callback.data.split(":")[1]
-        if side not in ("sell", "buy"):
-            return await safe_cb_answer(callback, "❌ Некорректный выбор", show_alert=True)
-        await state.update_data(amount_side=side)
-        await state.set_state(ClientFSM.entering_amount)
-        await callback.message.edit_text("Введите сумму:")
-        await safe_cb_answer(callback)
-    except Exception as e:
-        logger.error(f"cq_amount_side failed: {e}")
-        await safe_cb_answer(callback, "⚠️ Ошибка", show_alert=True)
+    cto = (message.text or "").upper().strip()
+    if not _CCY_RE.match(cto):
+        return await message.answer("❌ Укажите код валюты, пример: USD, EUR.")
+    await fsm_advance(state, ClientFSM.choosing_amount_side, currency_to=cto)
+    await message.answer("Укажите, какую сумму вводите:", reply_markup=IKB_AMOUNT_SIDE)
+
+async def cq_amount_side(callback: CallbackQuery, side: str, state: FSMContext):
+    if side not in ("sell", "buy"):
+        return safe_cb_answer(callback, "❌ Некорректный выбор", show_alert=True)
+    await fsm_advance(state, ClientFSM.entering_amount, amount_side=side)
+    safe_cb_answer(callback)
+    await callback.message.edit_text("Введите сумму:")
 
 @router.message(ClientFSM.entering_amount)
 async def fsm_amount(message: Message, state: FSMContext):
-    try:
-        try:
-            amount = float((message.text or "").replace(",", "."))
-        except ValueError:
-            return await message.answer("❌ Введите число, например: 1000.50")
-
-        await state.update_data(amount=amount)
-        await state.set_state(ClientFSM.entering_rate)
-        await message.answer(
-            "Введите ваш курс (BASE/QUOTE).\n"
-            "Примеры:\n"
-            "• Покупка/Продажа USD против UAH → курс USD/UAH\n"
-            "• Конверсия USD→EUR → курс USD/EUR\n\n"
-            "Можно оставить пусто — подставим заглушку."
-        )
-    except Exception as e:
-        logger.error(f"fsm_amount failed: {e}")
-        await message.answer("⚠️ Ошибка при вводе суммы.")
+    amount = parse_number(message.text)
+    if amount is None:
+        return await message.answer("❌ Введите число, например: 1000.50")
+
+    await fsm_advance(state, ClientFSM.entering_rate, amount=amount)
+    await message.answer(RATE_PROMPT)
 
 @router.message(ClientFSM.entering_rate)
 async def fsm_rate(message: Message, state: FSMContext):
-    try:
-        data = await state.get_data()
-        txt = (message.text or "").strip()
-        if txt:
-            try:
-                rate = float(txt.replace(",", "."))
-            except ValueError:
-                return await message.answer("❌ Курс должен быть числом, например 41.25")
-        else:
-            base = data["currency_from"]
-            quote = data.get("currency_to", "UAH")
-            pair = f"{base}/{quote}"
-            rate = get_stub_rates().get(pair, 1.0)
-
-        await state.update_data(rate=rate)
-
-        order = Order(
-            client_id=message.from_user.id,
-            client_telegram=message.from_user.username or "",
-            client_name=data.get("client_name", "N/A"),
-            operation=data["operation"],
-            amount=data["amount"],
-            currency_from=data["currency_from"],
-            currency_to=data.get("currency_to"),
-            rate=rate,
-            amount_side=data.get("amount_side"),
-        )
-        orders[order.id] = order
+    data = await state.get_data()
+    txt = (message.text or "").strip()
+    if txt:
+        rate = parse_number(txt)
+        if rate is None:
+            return await message.answer("❌ Курс должен быть числом, например 41.25")
+    else:
+        base = data["currency_from"]
+        quote = data.get("currency_to", "UAH")
+        pair = f"{base}/{quote}"
+        rate = get_stub_rates().get(pair, 1.0)
+
+    order = await order_create(
+        client_id=message.from_user.id,
+        client_telegram=message.from_user.username or "",
+        client_name=data.get("client_name", "N/A"),
+        operation=data["operation"],
+        amount=data["amount"],
+        currency_from=data["currency_from"],
+        currency_to=data.get("currency_to"),
+        rate=rate,
+        amount_side=data.get("amount_side"),
+    )
 
-        await state.clear()
-        await message.answer("✅ Ваша заявка создана:\n\n" + order.summary(), reply_markup=kb_main_client())
-
-        # Уведомим банк
-        for uid, role in user_roles.items():
-            if role == "bank":
-                with suppress(Exception):
-                    await bot.send_message(uid, "📥 Новая заявка:\n\n" + order.summary(),
-                                           reply_markup=ikb_bank_order(order.id))
-    except Exception as e:
-        logger.error(f"fsm_rate failed: {e}")
-        await message.answer("⚠️ Ошибка при вводе курса.")
+    # Событие для банков уже в Redis Stream — рассылку делает order_events_consumer
+    await fsm_reset(state)
+    await message.answer("✅ Ваша заявка создана:\n\n" + order.summary(), reply_markup=KB_MAIN_CLIENT)
 
 # ===================== CLIENT: /mytrades =====================
 @router.message(Command("mytrades"))
-@router.message(F.text == "🗂 Мои заявки")
-async def my_trades(message: Message):
-    try:
-        user_id = message.from_user.id
-        user_orders = [o for o in orders.values() if o.client_id == user_id]
-        if not user_orders:
-            return await message.answer("📭 У вас пока нет заявок.", reply_markup=kb_main_client())
-        chunks = []
-        for o in sorted(user_orders, key=lambda x: x.id, reverse=True):
-            chunks.append(o.summary())
-        text = "\n\n".join(chunks)
-        await message.answer("🗂 Ваши заявки:\n\n" + text, reply_markup=kb_main_client())
-    except Exception as e:
-        logger.error(f"/mytrades failed: {e}")
-        await message.answer("⚠️ Не удалось показать ваши заявки.")
+async def my_trades(message: Message, state: FSMContext):
+    # Последние MY_TRADES_LIMIT id клиента — сортировка и limit на стороне Redis
+    ids = await redis_conn.zrevrange(client_orders_key(message.from_user.id), 0, MY_TRADES_LIMIT - 1)
+    user_orders = await orders_load(ids)
+    if not user_orders:
+        return await message.answer("📭 У вас пока нет заявок.", reply_markup=KB_MAIN_CLIENT)
+    text = "\n\n".join(o.summary() for o in user_orders)
+    await message.answer("🗂 Ваши заявки:\n\n" + text, reply_markup=KB_MAIN_CLIENT)
 
 # ===================== BANK FLOW =====================
-@router.message(F.text == "📋 Все заявки")
-async def bank_orders(message: Message):
-    try:
-        if user_role(message.from_user.id) != "bank":
-            return await message.answer("❌ Эта команда доступна только банку.")
-        if not orders:
-            return await message.answer("📭 Нет заявок.")
-        for order in orders.values():
-            await message.answer(order.summary(), reply_markup=ikb_bank_order(order.id))
-    except Exception as e:
-        logger.error(f"bank_orders failed: {e}")
-        await message.answer("⚠️ Ошибка при показе заявок.")
-
-@router.callback_query(F.data.startswith("accept:"))
-async def cq_accept(callback: CallbackQuery):
-    try:
-        oid = int(callback.data.split(":")[1])
-        order = orders.get(oid)
-        if not order:
-            return await safe_cb_answer(callback, "❌ Заявка не найдена", show_alert=True)
-        order.status = "accepted"
-        await callback.message.edit_text(order.summary())
-        await safe_cb_answer(callback, "✅ Заявка принята")
-
-        # уведомим клиента
-        with suppress(Exception):
-            await bot.send_message(order.client_id, f"✅ Ваша заявка #{oid} принята банком.")
-    except Exception as e:
-        logger.error(f"cq_accept failed: {e}")
-        await safe_cb_answer(callback, "⚠️ Ошибка", show_alert=True)
-
-@router.callback_query(F.data.startswith("reject:"))
-async def cq_reject(callback: CallbackQuery):
-    try:
-        oid = int(callback.data.split(":")[1])
-        order = orders.get(oid)
-        if not order:
-            return await safe_cb_answer(callback, "❌ Заявка не найдена", show_alert=True)
-        order.status = "rejected"
-        await callback.message.edit_text(order.summary())
-        await safe_cb_answer(callback, "❌ Заявка отклонена")
-
-        # уведомим клиента
-        with suppress(Exception):
-            await bot.send_message(order.client_id, f"❌ Ваша заявка #{oid} отклонена банком.")
-    except Exception as e:
-        logger.error(f"cq_reject failed: {e}")
-        await safe_cb_answer(callback, "⚠️ Ошибка", show_alert=True)
-
-@router.callback_query(F.data.startswith("order:"))
-async def cq_order(callback: CallbackQuery):
-    try:
-        oid = int(callback.data.split(":")[1])
-        order = orders.get(oid)
-        if not order:
-            return await safe_cb_answer(callback, "❌ Заявка не найдена", show_alert=True)
-        order.status = "order"
-        await callback.message.edit_text(order.summary())
-        await safe_cb_answer(callback, "📌 Сохранено как ордер")
-
-        # уведомим клиента
-        with suppress(Exception):
-            await bot.send_message(order.client_id, f"📌 Ваша заявка #{oid} принята банком как ордер.")
-    except Exception as e:
-        logger.error(f"cq_order failed: {e}")
-        await safe_cb_answer(callback, "⚠️ Ошибка", show_alert=True)
+async def bank_orders(message: Message, state: FSMContext):
+    if await user_role(message.from_user.id) != "bank":
+        return await message.answer("❌ Эта команда доступна только банку.")
+    page = await bank_orders_page(0)
+    if page is None:
+        return await message.answer("📭 Нет заявок.")
+    text, kb = page
+    await message.answer(text, reply_markup=kb)
+
+async def bank_orders_page(page: int) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+    """Страница «Все заявки», новые сверху: один ZREVRANGE + один pipeline HGETALL."""
+    start = page * BANK_PAGE_SIZE
+    # +1 id, чтобы узнать, есть ли следующая страница
+    ids = await redis_conn.zrevrange(ORDERS_INDEX_KEY, start, start + BANK_PAGE_SIZE)
+    orders = await orders_load(ids[:BANK_PAGE_SIZE])
+    if not orders:
+        return None
+    text = f"📋 Все заявки (стр. {page + 1}):\n\n" + "\n\n".join(o.summary() for o in orders)
+    return text, ikb_bank_page([o.id for o in orders], page, len(ids) > BANK_PAGE_SIZE)
+
+async def cq_page(callback: CallbackQuery, arg: str, state: FSMContext):
+    if await user_role(callback.from_user.id) != "bank":
+        return safe_cb_answer(callback, "❌ Доступно только банку", show_alert=True)
+    page = await bank_orders_page(max(int(arg), 0))
+    if page is None:
+        return safe_cb_answer(callback, "📭 Нет заявок на этой странице", show_alert=True)
+    text, kb = page
+    safe_cb_answer(callback)
+    await callback.message.edit_text(text, reply_markup=kb)
+
+async def cq_pick(callback: CallbackQuery, arg: str, state: FSMContext):
+    if await user_role(callback.from_user.id) != "bank":
+        return safe_cb_answer(callback, "❌ Доступно только банку", show_alert=True)
+    order = await order_get(int(arg))
+    if not order:
+        return safe_cb_answer(callback, "❌ Заявка не найдена", show_alert=True)
+    safe_cb_answer(callback)
+    await callback.message.answer(order.summary(), reply_markup=ikb_bank_order(order.id))
+
+# действие банка -> (новый статус, ответ на callback, уведомление клиенту)
+_BANK_ACTIONS = {
+    "accept": ("accepted", "✅ Заявка принята", "✅ Ваша заявка #{} принята банком."),
+    "reject": ("rejected", "❌ Заявка отклонена", "❌ Ваша заявка #{} отклонена банком."),
+    "order": ("order", "📌 Сохранено как ордер", "📌 Ваша заявка #{} принята банком как ордер."),
+}
+
+async def cq_bank_action(action: str, callback: CallbackQuery, arg: str, state: FSMContext):
+    oid = int(arg)
+    if not await claim_callback(callback, f"order:{oid}:{action}"):
+        return safe_cb_answer(callback, "⏳ Уже обрабатывается")
+    status, answer, notice = _BANK_ACTIONS[action]
+    order = await order_set_status(oid, status)
+    if not order:
+        return safe_cb_answer(callback, "❌ Заявка не найдена", show_alert=True)
+    safe_cb_answer(callback, answer)
+    await callback.message.edit_text(order.summary())
+
+    # уведомим клиента
+    enqueue_message(order.client_id, notice.format(oid))
+
+# ===================== MENU DISPATCH =====================
+# Текст кнопки -> хендлер(message, state); ключи должны покрывать MENU_BUTTONS
+MENU_DISPATCH = {
+    "➕ Новая заявка": new_request,
+    "🗂 Мои заявки": my_trades,
+    "💱 Курсы": cmd_rate,
+    "📋 Все заявки": bank_orders,
+}
+
+# ===================== CALLBACK DISPATCH =====================
+# Один callback-хендлер вместо цепочки F.data.startswith(...):
+# префикс до ":" -> обработчик, аргумент после ":" передаётся как есть.
+CB_DISPATCH = {
+    "role": cq_role,
+    "deal": cq_deal,
+    "as": cq_amount_side,
+    **{action: partial(cq_bank_action, action) for action in _BANK_ACTIONS},
+    "page": cq_page,
+    "pick": cq_pick,
+}
+
+@router.callback_query()
+async def cq_dispatch(callback: CallbackQuery, state: FSMContext):
+    kind, _, arg = (callback.data or "").partition(":")
+    handler = CB_DISPATCH.get(kind)
+    if handler is None:
+        return safe_cb_answer(callback)
+    await handler(callback, arg, state)
+
+# ===================== ORDER EVENTS (Redis Stream) =====================
+# Новые заявки попадают в stream из order_create; рассылку банкам делает фоновый consumer.
+# Consumer group гарантирует, что при нескольких воркерах событие уйдёт один раз.
+ORDER_EVENTS_GROUP = "bank-notify"
+ORDER_EVENTS_CONSUMER = f"{socket.gethostname()}-{os.getpid()}"
+ORDER_EVENTS_CLAIM_INTERVAL = 60  # сек между XAUTOCLAIM
+
+async def _handle_order_events(entries):
+    # Стартовая загрузка банков не удалась — пробуем сейчас; при ошибке исключение,
+    # события остаются pending и будут перечитаны, а не подтверждены без получателей
+    if not bank_ids_loaded:
+        await refresh_bank_ids()
+    # Записи, уже срезанные MAXLEN, приходят без полей — их только подтверждаем
+    orders = await orders_load([fields["id"] for _, fields in entries if fields])  # один pipeline
+    by_id = {str(o.id): o for o in orders}
+    banks = tuple(bank_ids)
+    # XACK только тем событиям, чьи сообщения реально встали в send_queue
+    done = []
+    for eid, fields in entries:
+        order = by_id.get(fields["id"]) if fields else None
+        if order is not None and not notify_banks(order.id, order.summary(), banks):
+            break
+        done.append(eid)
+    if done:
+        await redis_conn.xack(ORDER_EVENTS_KEY, ORDER_EVENTS_GROUP, *done)
+    if len(done) < len(entries):
+        # Остаток — pending; consumer перечитает его после паузы
+        raise RuntimeError(f"send queue full, {len(entries) - len(done)} order events postponed")
+
+async def _claim_stale_order_events():
+    """Забирает события, которые другие consumer'ы (упавшие воркеры) держат без XACK дольше минуты."""
+    cursor = "0-0"
+    while True:
+        cursor, stale, *_ = await redis_conn.xautoclaim(
+            ORDER_EVENTS_KEY, ORDER_EVENTS_GROUP, ORDER_EVENTS_CONSUMER,
+            min_idle_time=60_000, start_id=cursor, count=100,
+        )
+        if stale:
+            await _handle_order_events(stale)
+        if cursor == "0-0":
+            return
+
+async def order_events_consumer():
+    """
+    Читает события новых заявок и рассылает их банкам.
+    После ошибки сначала дочитывает свои pending-записи (id "0"), потом снова берёт новые (">");
+    раз в ORDER_EVENTS_CLAIM_INTERVAL подбирает зависшие у других consumer'ов.
+    """
+    with suppress(ResponseError):  # BUSYGROUP — группа уже создана
+        await redis_conn.xgroup_create(ORDER_EVENTS_KEY, ORDER_EVENTS_GROUP, id="$", mkstream=True)
+    pending = True  # на старте тоже: вдруг у этого consumer'а что-то осталось
+    next_claim = 0.0
+    while True:
+        try:
+            if time.monotonic() >= next_claim:
+                await _claim_stale_order_events()
+                next_claim = time.monotonic() + ORDER_EVENTS_CLAIM_INTERVAL
+            resp = await redis_conn.xreadgroup(
+                ORDER_EVENTS_GROUP, ORDER_EVENTS_CONSUMER,
+                {ORDER_EVENTS_KEY: "0" if pending else ">"}, count=50,
+                block=None if pending else 5000,
+            )
+            entries = [entry for _stream, batch in resp or [] for entry in batch]
+            if entries:
+                await _handle_order_events(entries)
+            elif pending:
+                pending = False
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("order_events_consumer error: %s", e)
+            pending = True
+            await asyncio.sleep(1)
 
 # ===================== WEBHOOK MGMT + WATCHDOG + SELF-PING =====================
 _watchdog_task: Optional[asyncio.Task] = None
+_order_events_task: Optional[asyncio.Task] = None
+_sender_tasks: List[asyncio.Task] = []
 _self_ping_task: Optional[asyncio.Task] = None
+_bank_ids_task: Optional[asyncio.Task] = None
+_update_workers: List[asyncio.Task] = []
+# Апдейты, принятые вебхуком. Один пользователь — одна «полоса»: в update_queue от него
+# лежит не больше одного апдейта, остальные ждут в _chat_backlog. Иначе пачка апдейтов
+# одного чата занимает весь пул воркеров, которые стоят на замке ChatEventIsolation,
+# а остальные чаты ждут. Всего необработанных — не больше UPDATE_QUEUE_SIZE: при
+# переполнении вебхук ждёт места, и Telegram сам притормаживает доставку.
+update_queue: "asyncio.Queue[Tuple[Optional[int], types.Update]]" = asyncio.Queue()
+_chat_backlog: Dict[int, Deque[types.Update]] = {}  # ключ есть — апдейт пользователя уже в очереди/в работе
+_update_slots = asyncio.Semaphore(UPDATE_QUEUE_SIZE)
+# time.monotonic() последнего валидного апдейта — для webhook_watchdog
+_last_update_at = 0.0
 
 async def set_webhook_safely(url: str):
     """Ставит вебхук с защитой от Flood Control и подробным логом."""
     try:
-        # ВАЖНО: не дропаем накопленные апдейты
-        with suppress(Exception):
-            await bot.delete_webhook()
-
+        # set_webhook заменяет старый URL сам — отдельный delete_webhook не нужен.
+        # ВАЖНО: drop_pending_updates не передаём — накопленные апдейты не теряем
         await bot.set_webhook(
             url,
             secret_token=WEBHOOK_SECRET,
             allowed_updates=["message", "callback_query"],
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
         )
-        logger.info(f"Webhook set to {url}")
+        logger.info("Webhook set to %s", url)
     except TelegramRetryAfter as e:
         delay = max(int(e.retry_after), 1)
-        logger.warning(f"Flood control on set_webhook. Retry after {delay}s")
+        logger.warning("Flood control on set_webhook. Retry after %ss", delay)
         await asyncio.sleep(delay)
         await bot.set_webhook(
             url,
             secret_token=WEBHOOK_SECRET,
             allowed_updates=["message", "callback_query"],
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
         )
-        logger.info(f"Webhook set to {url} (after retry)")
+        logger.info("Webhook set to %s (after retry)", url)
     except TelegramBadRequest as e:
-        logger.error(f"BadRequest on set_webhook: {e}")
+        logger.error("BadRequest on set_webhook: %s", e)
         raise
     except Exception as e:
-        logger.error(f"Unexpected error on set_webhook: {e}")
+        logger.error("Unexpected error on set_webhook: %s", e)
         raise
 
 async def webhook_watchdog():
-    """Каждые WATCHDOG_INTERVAL сек проверяет URL вебхука, при расхождении — переустанавливает."""
+    """
+    Проверяет URL вебхука и при расхождении переустанавливает.
+    Пока всё в порядке, интервал удваивается до WATCHDOG_MAX_INTERVAL; после
+    расхождения или ошибки — снова WATCHDOG_INTERVAL. Если апдейт пришёл
+    недавно, getWebhookInfo не зовём: Telegram и так до нас достучался.
+    """
     desired = f"{WEBHOOK_BASE}{WEBHOOK_PATH}"
+    delay = WATCHDOG_INTERVAL
     while True:
-        try:
-            info = await bot.get_webhook_info()
-            current = info.url or ""
-            if current != desired:
-                logger.warning(f"Watchdog: webhook mismatch (current='{current}', desired='{desired}'). Fixing...")
-                with suppress(Exception):
-                    await set_webhook_safely(desired)
-            else:
-                logger.info("Watchdog: webhook OK.")
-        except Exception as e:
-            logger.error(f"Watchdog error: {e}")
-        await asyncio.sleep(WATCHDOG_INTERVAL)
+        if time.monotonic() - _last_update_at < delay:
+            logger.debug("Watchdog: recent update seen, skip check.")
+        else:
+            try:
+                info = await bot.get_webhook_info()
+                current = info.url or ""
+                if current != desired:
+                    logger.warning("Watchdog: webhook mismatch (current='%s', desired='%s'). Fixing...", current, desired)
+                    with suppress(Exception):
+                        await set_webhook_safely(desired)
+                    delay = WATCHDOG_INTERVAL
+                else:
+                    logger.info("Watchdog: webhook OK.")
+                    delay = min(delay * 2, WATCHDOG_MAX_INTERVAL)
+            except Exception as e:
+                logger.error("Watchdog error: %s", e)
+                delay = WATCHDOG_INTERVAL
+        await asyncio.sleep(delay)
 
 async def self_ping_loop():
     """Опциональный self-ping, чтобы Render не усыплял сервис (полезно на Free-плане)."""
@@ -637,35 +1242,47 @@ async def self_ping_loop():
         while True:
             try:
                 async with session.get(url) as resp:
-                    logger.info(f"Self-ping {url} -> {resp.status}")
+                    logger.info("Self-ping %s -> %s", url, resp.status)
             except Exception as e:
-                logger.warning(f"Self-ping error: {e}")
+                logger.warning("Self-ping error: %s", e)
             await asyncio.sleep(SELF_PING_INTERVAL)
 
-# ===================== FASTAPI ROUTES =====================
-@app.on_event("startup")
+# ===================== FASTAPI =====================
+BOT_COMMANDS = [
+    types.BotCommand(command="start", description="Запуск / выбор роли"),
+    types.BotCommand(command="menu", description="Главное меню"),
+    types.BotCommand(command="rate", description="Показать курсы"),
+    types.BotCommand(command="mytrades", description="Показать мои заявки"),
+    types.BotCommand(command="cancel", description="Отмена текущего действия"),
+    types.BotCommand(command="bank", description="Вход роли банк: /bank <пароль>"),
+]
+
 async def on_startup():
     try:
-        # Команды бота (подсказки в интерфейсе Telegram)
-        with suppress(Exception):
-            await bot.set_my_commands([
-                types.BotCommand(command="start", description="Запуск / выбор роли"),
-                types.BotCommand(command="menu", description="Главное меню"),
-                types.BotCommand(command="rate", description="Показать курсы"),
-                types.BotCommand(command="mytrades", description="Показать мои заявки"),
-                types.BotCommand(command="cancel", description="Отмена текущего действия"),
-                types.BotCommand(command="bank", description="Вход роли банк: /bank <пароль>"),
-            ])
-
-        # Проверка Redis
-        with suppress(Exception):
-            pong = await redis_conn.ping()
-            if pong:
+        # Независимые сетевые шаги — параллельно. get_me заодно прогревает
+        # aiohttp-сессию (DNS + TLS), чтобы первый апдейт не платил за это.
+        steps = {
+            "set_my_commands": bot.set_my_commands(BOT_COMMANDS),
+            "redis ping": redis_conn.ping(),
+            "bank ids": refresh_bank_ids(),
+            "get_me": bot.get_me(),
+            "set_webhook": set_webhook_safely(f"{WEBHOOK_BASE}{WEBHOOK_PATH}"),
+        }
+        results = await asyncio.gather(*steps.values(), return_exceptions=True)
+        for name, res in zip(steps, results):
+            if isinstance(res, Exception):
+                logger.error("Startup step %s failed: %s", name, res)
+            elif name == "redis ping":
                 logger.info("Redis connected OK.")
 
-        # Вебхук
-        desired = f"{WEBHOOK_BASE}{WEBHOOK_PATH}"
-        await set_webhook_safely(desired)
+        # Воркеры входящих апдейтов и исходящей очереди
+        _update_workers.extend(asyncio.create_task(update_worker()) for _ in range(UPDATE_WORKERS))
+        _sender_tasks.extend(asyncio.create_task(sender_worker()) for _ in range(SEND_CONCURRENCY))
+
+        # Рассылка новых заявок банкам
+        global _order_events_task, _bank_ids_task
+        _order_events_task = asyncio.create_task(order_events_consumer())
+        _bank_ids_task = asyncio.create_task(bank_ids_refresher())
 
         # Старт watchdog
         global _watchdog_task
@@ -676,12 +1293,16 @@ async def on_startup():
         if SELF_PING_ENABLE:
             _self_ping_task = asyncio.create_task(self_ping_loop())
 
-        logger.info(f"Startup complete. Watchdog enabled (interval={WATCHDOG_INTERVAL}s).")
+        logger.info("Startup complete. Watchdog enabled (interval=%ss).", WATCHDOG_INTERVAL)
     except Exception as e:
-        logger.error(f"Startup failed: {e}")
+        logger.error("Startup failed: %s", e)
 
-@app.on_event("shutdown")
 async def on_shutdown():
+    # Дорабатываем уже принятые апдейты, потом гасим воркеры
+    with suppress(Exception):
+        await asyncio.wait_for(update_queue.join(), timeout=10)
+    for task in _update_workers:
+        task.cancel()
     with suppress(Exception):
         if _watchdog_task:
             _watchdog_task.cancel()
@@ -689,11 +1310,30 @@ async def on_shutdown():
         if _self_ping_task:
             _self_ping_task.cancel()
     with suppress(Exception):
-        await redis_conn.close()
+        if _order_events_task:
+            _order_events_task.cancel()
+    with suppress(Exception):
+        if _bank_ids_task:
+            _bank_ids_task.cancel()
+    # События заявок подтверждены после постановки в send_queue — досылаем очередь,
+    # иначе уведомления банкам пропадут при каждом деплое
+    with suppress(Exception):
+        await asyncio.wait_for(send_queue.join(), timeout=10)
+    for task in _sender_tasks:
+        task.cancel()
+    await asyncio.gather(redis_conn.aclose(), bot.session.close(), return_exceptions=True)
     with suppress(Exception):
-        await bot.session.close()
+        await redis_pool.disconnect()
     logger.info("Shutdown complete.")
 
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    await on_startup()
+    yield
+    await on_shutdown()
+
+app = FastAPI(title="FXBankBot", version="2.0.1", lifespan=lifespan)
+
 @app.get("/")
 async def index():
     return {
@@ -703,19 +1343,80 @@ async def index():
         "self_ping": SELF_PING_ENABLE,
     }
 
+def _update_lane(update: types.Update) -> Optional[int]:
+    """Ключ полосы: id пользователя (в личке это и есть чат), иначе id чата."""
+    with suppress(Exception):
+        event = update.event
+        user = getattr(event, "from_user", None)
+        if user is not None:
+            return user.id
+        chat = getattr(event, "chat", None)
+        if chat is not None:
+            return chat.id
+    return None
+
+async def enqueue_update(update: types.Update):
+    await _update_slots.acquire()
+    lane = _update_lane(update)
+    if lane is not None:
+        backlog = _chat_backlog.get(lane)
+        if backlog is not None:
+            # Предыдущий апдейт пользователя ещё не обработан — воркер поставит этот следом
+            backlog.append(update)
+            return
+        _chat_backlog[lane] = deque()
+    update_queue.put_nowait((lane, update))
+
+async def update_worker():
+    while True:
+        lane, update = await update_queue.get()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.error("Update %s failed: %s", update.update_id, e)
+        finally:
+            _update_slots.release()
+            if lane is not None:
+                # Следующий апдейт полосы — в конец общей очереди, чтобы не обгонять другие чаты
+                backlog = _chat_backlog[lane]
+                if backlog:
+                    update_queue.put_nowait((lane, backlog.popleft()))
+                else:
+                    del _chat_backlog[lane]
+            update_queue.task_done()
+
+# Ответы вебхука постоянные — готовые байты, без jsonable_encoder/json.dumps на каждый апдейт.
+# Response без background-задач не хранит состояние запроса, переиспользовать безопасно.
+_WEBHOOK_OK = Response(content=b'{"ok":true}', media_type="application/json")
+_WEBHOOK_FAIL = Response(content=b'{"ok":false}', media_type="application/json")
+
 @app.post(WEBHOOK_PATH)
 async def webhook(request: Request):
+    # Telegram'у нужен только быстрый 200: обработку делают update_worker'ы,
+    # иначе медленный хендлер задерживает ответ и Telegram шлёт апдейт повторно.
     try:
         raw = await request.body()
-        update = types.Update.model_validate_json(raw)
-        # ВАЖНО: секрет передаём именованным аргументом, иначе третий позиционный — timeout (int)
-        await dp.feed_webhook_update(bot, update, secret_token=WEBHOOK_SECRET)
+        # context с bot: иначе update.bot != bot, и feed_update пересоздаёт апдейт
+        # через model_dump() + model_validate() — второй полный проход на каждый апдейт
+        update = types.Update.model_validate_json(raw, context={"bot": bot})
     except Exception as e:
-        logger.error(f"Webhook error: {e}")
-        return {"ok": False}
-    return {"ok": True}
+        logger.error("Webhook error: %s", e)
+        return _WEBHOOK_FAIL
+    global _last_update_at
+    _last_update_at = time.monotonic()
+    await enqueue_update(update)
+    return _WEBHOOK_OK
 
 # ===================== ENTRY =====================
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("app:app", host=HOST, port=PORT, reload=False)
+    uvicorn.run(
+        "app:app",
+        host=HOST,
+        port=PORT,
+        reload=False,
+        loop="uvloop",
+        http="httptools",
+        workers=WEB_CONCURRENCY,
+        backlog=2048,
+    )
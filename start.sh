@@ -3,6 +3,11 @@ set -e
 
 echo "Starting FXBankBot..."
 
-# Запускаем FastAPI (uvicorn)
-exec uvicorn app:app --host 0.0.0.0 --port ${PORT:-10000}
+# Запускаем FastAPI (uvicorn): uvloop + httptools (входят в uvicorn[standard]).
+# WEB_CONCURRENCY > 1: замок чата переезжает в Redis, лимит исходящей очереди
+# умножается, set_webhook/watchdog работают в каждом воркере — см. app.py (CONFIG)
+exec uvicorn app:app --host 0.0.0.0 --port ${PORT:-10000} \
+    --loop uvloop --http httptools \
+    --workers ${WEB_CONCURRENCY:-1} \
+    --backlog 2048
 